@@ -1,22 +1,96 @@
 from __future__ import annotations
+import hashlib
 import io
+import itertools
+import os
+import subprocess
+import tempfile
 import time
-from dataclasses import dataclass, asdict
-from datetime import datetime
-from typing import List, Optional, Dict, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timezone
+from typing import Callable, Deque, List, Optional, Dict, Any
+import numpy as np
+import torch
 import whisperx
-import tempfile
 
 import streamlit as st
 
 st.set_page_config(page_title="Meeting Minion", page_icon="📝", layout="wide")
-device = "cpu"
-batch_size = 4 # reduce if low on GPU mem
-compute_type = "int8" # change to "int8" if low on GPU mem (may reduce accuracy)
+device = "cuda" if torch.cuda.is_available() else "cpu"
+batch_size = 16 # throughput scales with batch; reduce if low on (GPU) memory
+compute_type = "float16" if device == "cuda" else "int8" # CTranslate2 int8 quantized weights on CPU
 model_dir = "./model/whisperx_base"
-model = whisperx.load_model("base", device, compute_type=compute_type, download_root=model_dir)
-alignment_model, alignment_metadata = whisperx.load_align_model(language_code="en", device=device)
+# CPU only (CUDA keeps float16 "base"). Pre-converted with:
+#   ct2-transformers-converter --model openai/whisper-base --quantization int8 \
+#       --copy_files tokenizer.json preprocessor_config.json --output_dir ./model/whisperx_base_ct2_int8
+# Falls back to downloading "base" when the converted model is not present.
+ct2_model_dir = "./model/whisperx_base_ct2_int8"
+# Resolved here so it is part of get_asr's cache key rather than a global read inside it.
+whisper_arch = ct2_model_dir if device == "cpu" and os.path.isdir(ct2_model_dir) else "base"
 hf_token = ""  # Add your Hugging Face token here if needed
+decode_ahead = 1  # uploads decoded (and queued for diarization) ahead of the one being transcribed
+compile_models = os.environ.get("MEETING_MINION_COMPILE") == "1"  # torch.compile the alignment/diarization models
+
+
+def _try_compile(module):
+    # Opt-in: torch.compile is lazy, so a bad graph only fails on the first real forward pass, not here.
+    if not compile_models or not hasattr(torch, "compile"):
+        return module
+    return torch.compile(module)
+
+
+def _try_quantize(module, device: str):
+    # Dynamic int8 for the Linear layers; only worthwhile (and supported) on CPU.
+    if device != "cpu":
+        return module
+    try:
+        return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+    except Exception:
+        return module
+
+
+@st.cache_resource(show_spinner=False)
+def get_executor() -> ThreadPoolExecutor:
+    # Shared by every session, so background work doesn't spin up a pool per upload. A single worker because every
+    # job calls the one cached pyannote pipeline, which isn't documented as safe for concurrent calls, and on CPU a
+    # second diarization would only compete with ASR for the same cores.
+    return ThreadPoolExecutor(max_workers=1)
+
+
+@st.cache_resource(show_spinner=False)
+def get_asr(whisper_arch: str, device: str, compute_type: str, model_dir: str):
+    return whisperx.load_model(
+        whisper_arch, device, compute_type=compute_type, download_root=model_dir
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_align(device: str):
+    alignment_model, alignment_metadata = whisperx.load_align_model(language_code="en", device=device)
+    return _try_compile(alignment_model), alignment_metadata
+
+
+@st.cache_resource(show_spinner=False)
+def get_diarize(hf_token: str, device: str):
+    diarize_model = whisperx.diarize.DiarizationPipeline(
+        "pyannote/speaker-diarization-3.1", use_auth_token=hf_token, device=torch.device(device)
+    )
+    # Quantize + compile the nn.Modules inside the pyannote pipeline, not the pipeline wrapper itself.
+    # These are pyannote internals, so skip quietly if the layout differs.
+    pipeline = diarize_model.model
+    try:
+        pipeline._segmentation.model = _try_compile(_try_quantize(pipeline._segmentation.model, device))
+    except AttributeError:
+        pass
+    try:
+        pipeline._embedding.model_ = _try_compile(_try_quantize(pipeline._embedding.model_, device))
+    except AttributeError:
+        pass
+    return diarize_model
+
+
 @dataclass
 class MeetingRecord:
     id: str
@@ -25,23 +99,85 @@ class MeetingRecord:
     transcript: str
     summary: List[str]
     action_items: List[str]
+    # Rendered once when the record is built so reruns don't rebuild them.
+    summary_md: str = field(init=False)
+    summary_preview_md: str = field(init=False)
+    action_items_md: str = field(init=False)
+    transcript_bytes: bytes = field(init=False)
+    summary_bytes: bytes = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.summary_md = "\n".join(f"- {item}" for item in self.summary)
+        self.summary_preview_md = "\n".join(f"- {s}" for s in self.summary[:3])
+        self.action_items_md = "\n".join(f"- {ai}" for ai in self.action_items)
+        self.transcript_bytes = self.transcript.encode("utf-8")
+        self.summary_bytes = "\n".join(self.summary).encode("utf-8")
 
 
 def _init_state() -> None:
     if "history" not in st.session_state:
-        st.session_state.history: List[MeetingRecord] = []
+        st.session_state.history: Deque[MeetingRecord] = deque(maxlen=1000)
     if "history_page" not in st.session_state:
         st.session_state.history_page = 0
+    if "audio_key" not in st.session_state:
+        st.session_state.audio_key = None
+    if "audio_transcript" not in st.session_state:
+        st.session_state.audio_transcript = []
 
 
-def _now_id() -> str:
-    return datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+def _now_id(now: Optional[datetime] = None) -> str:
+    return (now or datetime.now(timezone.utc)).strftime("%Y%m%d%H%M%S%f")
 
 
-def run_pipeline(audio_bytes: Optional[bytes], transcript_text: Optional[str]) -> Dict[str, Any]:
+# MP4-family containers often keep their index (the "moov" atom) at the end of the file, which ffmpeg can only
+# reach on a seekable input; other formats stream fine through stdin.
+_SEEKABLE_EXTS = {".m4a", ".mp4", ".mov"}
 
+
+def _run_ffmpeg(src: str, data: Optional[bytes] = None, pass_fds: tuple = (), sr: int = 16000) -> bytes:
+    cmd = ["ffmpeg", "-nostdin", "-threads", "0", "-i", src, "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "pipe:1"]
+    proc = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE if data is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds,
+    )
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Failed to load audio: {err.decode(errors='ignore')}")
+    return out
+
+
+def _decode_audio(data: bytes, name: str = "", sr: int = 16000) -> np.ndarray:
+    # Same output as whisperx.load_audio, without writing wav/mp3 uploads to disk first.
+    ext = os.path.splitext(name)[1].lower()
+    if ext not in _SEEKABLE_EXTS:
+        out = _run_ffmpeg("pipe:0", data, sr=sr)
+    elif hasattr(os, "memfd_create"):
+        # In-memory file: seekable for ffmpeg, nothing on disk, gone once the fd is closed.
+        fd = os.memfd_create("upload")
+        try:
+            with os.fdopen(os.dup(fd), "wb") as f:
+                f.write(data)
+            out = _run_ffmpeg(f"/proc/self/fd/{fd}", pass_fds=(fd,), sr=sr)
+        finally:
+            os.close(fd)
+    else:
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=ext)
+        try:
+            with tmp:
+                tmp.write(data)
+            out = _run_ffmpeg(tmp.name, sr=sr)
+        finally:
+            os.unlink(tmp.name)
+    # One contiguous float32 buffer, scaled in place, shared by ASR, alignment and diarization.
+    audio = np.frombuffer(out, np.int16).astype(np.float32)
+    audio /= 32768.0
+    return audio
+
+
+@st.cache_data(show_spinner=False)
+def _summarize_cached(transcript_hash: str, _transcript: str) -> Dict[str, List[str]]:
+    # Keyed on the hash only; the leading underscore keeps Streamlit from hashing the full transcript.
     time.sleep(0.2)
-    transcript = transcript_text or "[PLACEHOLDER]\n"
     summary = [
         "Key decision: TODO — replace with model output",
         "Discussion point: TODO — replace with model output",
@@ -49,18 +185,43 @@ def run_pipeline(audio_bytes: Optional[bytes], transcript_text: Optional[str]) -
     action_items = [
         "@owner — TODO action, due MM/DD",
     ]
-    return {"transcript": transcript, "summary": summary, "action_items": action_items}
+    return {"summary": summary, "action_items": action_items}
+
+
+def run_pipeline(transcript_text: Optional[str], progress_cb: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+
+    transcript = transcript_text or "[PLACEHOLDER]\n"
+    if progress_cb is not None:
+        progress_cb("Summarizing…")
+    h = hashlib.sha256(transcript.encode("utf-8")).hexdigest()
+    return {"transcript": transcript, **_summarize_cached(h, transcript)}
+
+
+def _render_line(line: str, words: tuple) -> str:
+    if not words:
+        return line
+    # Words whisperx couldn't align (e.g. bare numbers) have no start time and are shown as-is.
+    return " ".join(word if start is None else f"[{start:.2f}s] {word}" for word, start in words)
+
+
+def _render_transcript(parts: List[tuple], name_map: Dict[str, str]) -> str:
+    texts = []
+    for file_name, segments in parts:
+        text = "\n".join(
+            f"{name_map.get(speaker, speaker)}: {_render_line(line, words)}" for speaker, line, words in segments
+        )
+        texts.append(text if len(parts) == 1 else f"[{file_name}]\n{text}")
+    return "\n\n".join(texts)
+
 
 def sidebar_uploader() -> Dict[str, Any]:
     st.sidebar.header("Upload")
 
-    if "audio_file" not in st.session_state:
-        st.session_state.audio_name = None
-
-    audio_file = st.sidebar.file_uploader(
-        "Audio file (.mp3, .wav, .m4a)", type=["mp3", "wav", "m4a"], accept_multiple_files=False
+    audio_files = st.sidebar.file_uploader(
+        "Audio files (.mp3, .wav, .m4a)", type=["mp3", "wav", "m4a"], accept_multiple_files=True
     )
 
+    word_timestamps = st.sidebar.checkbox("Word-level timestamps", value=False)
     speakers = st.sidebar.slider("Pick the number of speakers in the audio", min_value = 1, max_value = 5)
     speaker_names = ["" for _ in range(speakers)]
     for i in range(speakers):
@@ -69,33 +230,80 @@ def sidebar_uploader() -> Dict[str, Any]:
     transcript_text = ""
     st.subheader("Transcript")
     transcript_box = st.empty()
-    if audio_file is not None and audio_file.name != st.session_state.audio_name:
-        st.session_state.audio_name = audio_file.name
+    # Speakers left blank keep their diarization label instead of becoming "".
+    name_map = {f"SPEAKER_0{i}": speaker_names[i] for i in range(speakers) if speaker_names[i]}
+    # Anything that changes the ASR/diarization output has to be part of the key, not just the file names.
+    audio_key = (tuple(f.name for f in audio_files), speakers, word_timestamps)
+    if not audio_files:
+        st.session_state.audio_key = None
+        st.session_state.audio_transcript = []
+
+    for audio_file in audio_files:
         st.audio(audio_file)
-        suffix = "." + audio_file.name.split(".")[-1].lower()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(audio_file.read())
-            tmp_path = tmp.name
-
-        audio = whisperx.load_audio(tmp_path)
-        result = model.transcribe(audio, batch_size=batch_size)
-        transcript_box.code("\n".join([seg["text"] for seg in result["segments"]]), language="text")
-
-        result = whisperx.align(result["segments"], alignment_model, alignment_metadata, audio, device, return_char_alignments=False)
-        transcript_box.code("\n".join([seg["text"] for seg in result["segments"]]), language="text")
-        
-        diarize_model = whisperx.diarize.DiarizationPipeline("pyannote/speaker-diarization-3.0", use_auth_token=hf_token, device=device)
-        diarize_segments = diarize_model(audio, min_speakers=speakers, max_speakers=speakers)
-        result = whisperx.assign_word_speakers(diarize_segments, result)
-        transcript_text = "\n".join([(seg["speaker"] + ": " + seg["text"]) for seg in result["segments"]])
-        for i in range(speakers):
-            transcript_text = transcript_text.replace("SPEAKER_0"+str(i), speaker_names[i])
+
+    if audio_files and audio_key != st.session_state.audio_key:
+        st.session_state.audio_key = None
+        st.session_state.audio_transcript = []
+        model = get_asr(whisper_arch, device, compute_type, model_dir)
+        diarize_model = get_diarize(hf_token, device)
+
+        # Stage labels instead of re-sending the growing transcript to the browser after every step.
+        with st.status("Decoding audio…") as status:
+            # Diarization only needs the raw audio, so it runs alongside ASR + alignment. Only decode and queue
+            # decode_ahead files ahead of the ASR loop so a large batch of uploads isn't all held in memory at once.
+            pending = deque()
+            upcoming = iter(audio_files)
+
+            def queue_next() -> None:
+                audio_file = next(upcoming, None)
+                if audio_file is None:
+                    return
+                audio = _decode_audio(audio_file.getvalue(), audio_file.name)
+                future = get_executor().submit(diarize_model, audio, min_speakers=speakers, max_speakers=speakers)
+                pending.append((audio_file, audio, future))
+
+            for _ in range(decode_ahead):
+                queue_next()
+
+            parts = []
+            while pending:
+                audio_file, audio, diar_future = pending.popleft()
+                queue_next()
+                status.update(label=f"Transcribing {audio_file.name}…")
+                result = model.transcribe(audio, batch_size=batch_size)
+                # Speakers are assigned by segment overlap, so the wav2vec2 alignment pass is only needed for word timings.
+                if word_timestamps:
+                    status.update(label=f"Aligning {audio_file.name}…")
+                    alignment_model, alignment_metadata = get_align(device)
+                    result = whisperx.align(result["segments"], alignment_model, alignment_metadata, audio, device, return_char_alignments=False)
+
+                status.update(label=f"Diarizing {audio_file.name}…")
+                diarize_segments = diar_future.result()
+                result = whisperx.assign_word_speakers(diarize_segments, result)
+                # Segments with no overlapping diarization turn have no "speaker" key. Word start times only
+                # exist after alignment; without it words stays empty and the plain segment text is shown.
+                segments = [
+                    (
+                        seg.get("speaker", "Unknown"),
+                        seg["text"],
+                        tuple((w["word"], w.get("start")) for w in seg.get("words", ())) if word_timestamps else (),
+                    )
+                    for seg in result["segments"]
+                ]
+                parts.append((audio_file.name, segments))
+            # Keep the raw diarization labels so renaming speakers later doesn't need another run. The key is only
+            # stored once every file went through, so a failed run is retried on the next rerun.
+            st.session_state.audio_transcript = parts
+            st.session_state.audio_key = audio_key
+            if device == "cuda":
+                # Release activations cached by diarization/ASR before the next upload.
+                torch.cuda.empty_cache()
+            status.update(label="Transcription complete.", state="complete")
+
+    if st.session_state.audio_transcript:
+        transcript_text = _render_transcript(st.session_state.audio_transcript, name_map)
         transcript_box.code(transcript_text, language="text")
 
-    for i in range(speakers):
-        transcript_text = transcript_text.replace("SPEAKER_0"+str(i), speaker_names[i])
-    transcript_box.code(transcript_text, language="text")
-        
     st.sidebar.markdown("**OR** paste a transcript:")
     transcript_text = st.sidebar.text_area("Transcript", placeholder="Paste transcript text here…", value=transcript_text, height=160)
 
@@ -103,16 +311,7 @@ def sidebar_uploader() -> Dict[str, Any]:
 
     process = st.sidebar.button("Process", type="primary", use_container_width=True)
 
-    return {"audio_file": audio_file, "transcript_text": transcript_text.strip() or None, "title": title.strip(), "process": process}
-
-
-def progress_runner(label: str = "Processing") -> None:
-    progress = st.progress(0, text=label)
-    for i in range(1, 101, 8):
-        time.sleep(0.04)
-        progress.progress(min(i, 100), text=label)
-    time.sleep(0.05)
-    progress.empty()
+    return {"audio_files": audio_files, "transcript_text": transcript_text.strip() or None, "title": title.strip(), "process": process}
 
 
 def results_panel(record: MeetingRecord) -> None:
@@ -123,19 +322,19 @@ def results_panel(record: MeetingRecord) -> None:
         with st.expander("Transcript", expanded=True):
             st.code(record.transcript or "", language="text")
             st.download_button(
-                "Download transcript", data=record.transcript.encode("utf-8"), file_name=f"{record.id}_transcript.txt"
+                "Download transcript", data=record.transcript_bytes, file_name=f"{record.id}_transcript.txt"
             )
 
         with st.expander("Structured Summary", expanded=True):
-            st.markdown("\n".join([f"- {item}" for item in record.summary]) or "_No summary._")
+            st.markdown(record.summary_md or "_No summary._")
             st.download_button(
                 "Download summary (.txt)",
-                data=("\n".join(record.summary)).encode("utf-8"),
+                data=record.summary_bytes,
                 file_name=f"{record.id}_summary.txt",
             )
 
         with st.expander("Action Items", expanded=True):
-            st.markdown("\n".join([f"- {ai}" for ai in record.action_items]) or "_No action items._")
+            st.markdown(record.action_items_md or "_No action items._")
 
     with right:
         st.subheader("Meta")
@@ -143,15 +342,16 @@ def results_panel(record: MeetingRecord) -> None:
 
 
 def save_record(title: str, payload: Dict[str, Any]) -> MeetingRecord:
+    now = datetime.now(timezone.utc)
     rec = MeetingRecord(
-        id=_now_id(),
-        created_at=datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        id=_now_id(now),
+        created_at=now.strftime("%Y-%m-%dT%H:%M:%SZ"),
         title=title or "Untitled Meeting",
         transcript=payload.get("transcript", ""),
         summary=payload.get("summary", []),
         action_items=payload.get("action_items", []),
     )
-    st.session_state.history.insert(0, rec)
+    st.session_state.history.appendleft(rec)
     return rec
 
 
@@ -168,11 +368,11 @@ def history_panel(page_size: int = 5) -> None:
 
     st.caption(f"Showing {start+1}–{end} of {total}")
 
-    for rec in history[start:end]:
+    for rec in itertools.islice(history, start, end):
         with st.container(border=True):
             st.markdown(f"**{rec.title}** · _{rec.created_at}_")
             st.markdown("**Summary preview:**")
-            st.write("\n".join([f"- {s}" for s in rec.summary[:3]]) or "(empty)")
+            st.write(rec.summary_preview_md or "(empty)")
             cols = st.columns(3)
             with cols[0]:
                 if st.button("View", key=f"view_{rec.id}"):
@@ -180,14 +380,14 @@ def history_panel(page_size: int = 5) -> None:
             with cols[1]:
                 st.download_button(
                     "Download transcript",
-                    data=rec.transcript.encode("utf-8"),
+                    data=rec.transcript_bytes,
                     file_name=f"{rec.id}_transcript.txt",
                     key=f"dl_t_{rec.id}",
                 )
             with cols[2]:
                 st.download_button(
                     "Download summary",
-                    data=("\n".join(rec.summary)).encode("utf-8"),
+                    data=rec.summary_bytes,
                     file_name=f"{rec.id}_summary.txt",
                     key=f"dl_s_{rec.id}",
                 )
@@ -214,16 +414,15 @@ def main() -> None:
         st.write("Upload audio")
 
         if controls["process"]:
-            if not controls["audio_file"] and not controls["transcript_text"]:
+            if not controls["audio_files"] and not controls["transcript_text"]:
                 st.warning("Please upload an audio file or paste a transcript.")
             else:
-                audio_bytes = None
-                if controls["audio_file"] is not None:
-                    audio_bytes = controls["audio_file"].read()
-
-                progress_runner("Processing meeting…")
-
-                result = run_pipeline(audio_bytes=audio_bytes, transcript_text=controls["transcript_text"])
+                with st.status("Processing meeting…") as status:
+                    result = run_pipeline(
+                        transcript_text=controls["transcript_text"],
+                        progress_cb=lambda label: status.update(label=label, state="running"),
+                    )
+                    status.update(label="Processing complete.", state="complete")
 
                 rec = save_record(controls["title"], result)
                 results_panel(rec)
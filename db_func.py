@@ -1,21 +1,56 @@
 '''
 Contains all the CRUD functions of a db + table.
 '''
+import functools
+import re
 import sqlite3
+import sys
+
+# sqlite3 keeps an LRU of prepared statements per connection keyed by sql text (default 128);
+# the builders below produce stable sql text, so a bigger cache means fewer re-parses.
+STATEMENT_CACHE_SIZE = 256
+
+_ORDER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\s+(ASC|DESC))?$", re.IGNORECASE)
+
+
+'''
+Connection tuning -> foreign key enforcement, WAL journal + synchronous=NORMAL (one fsync per commit, readers don't block the writer),
+temp tables/sorts in memory, a 64MB page cache and mmap'd reads. WAL is skipped for in-memory databases,
+mmap on 32-bit builds (not enough address space for a 256MB map).
+'''
+def _tune_connection(conn, path):
+    if(path != ":memory:"):
+        conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    if(sys.maxsize > 2**32):
+        conn.execute("PRAGMA mmap_size=268435456;")
 
 
 def create_database(name: str):
-    conn = sqlite3.connect(f"{name}.db")
+    conn = sqlite3.connect(f"{name}.db", cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    _tune_connection(conn, f"{name}.db")
     return conn
 
 def connect_database(path: str):
-    conn = sqlite3.connect(f"{path}")
+    conn = sqlite3.connect(f"{path}", cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    _tune_connection(conn, f"{path}")
     return conn
 
 '''
 spec: dictionary: column_name : [datatype, specifiers]. + Primary Key : column_name + Foreign Key : [(column name,ref_table)]
++ Index : [column_name or (column_name, column_name, ...)]
+
+a Foreign Key entry can also be (column name,ref_table,on_delete) e.g. ("meeting_id","meetings","CASCADE") -> deleting the
+parent row deletes its children in the same statement, no separate DELETE per child table.
+foreign keys are enforced (PRAGMA foreign_keys=ON is set when the connection is opened).
+
+every entry in Index gets a CREATE INDEX IF NOT EXISTS IDX_<TABLE>_<COLUMNS> after the table is created -> use it for
+columns that show up in where clauses / order by (user ids, meeting ids, created_at ...).
 
 any column with primary key will automatically have the NOT NULL , UNIQUE charecteristic added to it.
 
@@ -29,30 +64,41 @@ If we have a datatype(arg) .. make sure to add in the args too.
 
 all column names are automatically uppercased (handled inside the functions)
 
+if_not_exists=True -> CREATE TABLE IF NOT EXISTS, a no-op when the table is already there. call it unconditionally at
+startup instead of probing for the table with a select first.
+
 '''
-def create_table(conn, spec, name):
-    f_string = ""
+def create_table(conn, spec, name, if_not_exists=False):
+    lines = []
     for col,type_list in spec.items():
-        if(col == "Primary Key" or col == "Foreign Key"):
+        if(col == "Primary Key" or col == "Foreign Key" or col == "Index"):
             continue
 
-        f_string += col.upper() + " " + type_list[0].upper() + " "
+        line = col.upper() + " " + type_list[0].upper() + " "
         if("Primary Key" in spec and spec["Primary Key"] == col):
-            f_string += "NOT NULL UNIQUE PRIMARY KEY,\n"
+            line += "NOT NULL UNIQUE PRIMARY KEY"
         elif(len(type_list) > 1):
-            f_string += type_list[1] + ",\n"
-        else:
-            f_string += ",\n"
+            line += type_list[1]
+        lines.append(line)
 
     if("Foreign Key" in spec):
-        for (col,ref) in spec["Foreign Key"]:
-            f_string += "FOREIGN KEY (" + col.upper() + ") REFERENCES " + ref.upper() + "(" + col.upper() + "),\n"
-
-    f_string = f_string[:-2] + "\n"
+        for fk in spec["Foreign Key"]:
+            col, ref = fk[0], fk[1]
+            line = "FOREIGN KEY (" + col.upper() + ") REFERENCES " + ref.upper() + "(" + col.upper() + ")"
+            if(len(fk) > 2):
+                line += " ON DELETE " + fk[2].upper()
+            lines.append(line)
 
     cursor = conn.cursor()
-    query = "CREATE TABLE " + name.upper() + "(" + f_string + ");"
+    query = "CREATE TABLE " + ("IF NOT EXISTS " if if_not_exists else "") + name.upper() + "(" + ",\n".join(lines) + "\n);"
     cursor.execute(query)
+
+    if("Index" in spec):
+        for idx in spec["Index"]:
+            cols = [idx] if type(idx) == str else list(idx)
+            idx_name = "IDX_" + name.upper() + "_" + "_".join(c.upper() for c in cols)
+            cursor.execute("CREATE INDEX IF NOT EXISTS " + idx_name + " ON " + name.upper() + "(" + ",".join(c.upper() for c in cols) + ");")
+
     cursor.close()
     return
 
@@ -67,133 +113,192 @@ def drop_table(conn,name):
 
 '''
 Insert (by value) -> dictionary based insert.
-'''
-def single_insert(conn,cmd_dict,name):
-    col_str = ""
-    val_str = ""
-    val_list = []
 
-    for (col,val) in cmd_dict.items():
-        col_str += col.upper() + " ,"
-        val_str += "?,"
-        val_list.append(val)
+single_insert / many_insert / update / delete all commit by default. To group several writes into one transaction
+(one fsync instead of one per call) pass commit=False and wrap them in the connection's context manager:
 
-    col_str = col_str[:-1]
-    val_str = val_str[:-1]
+    with conn:
+        single_insert(conn, row, "meetings", commit=False)
+        many_insert(conn, points, "key_points", commit=False)
+
+the with block commits once at the end, or rolls everything back if any of them raises.
+'''
+def single_insert(conn,cmd_dict,name,commit=True):
+    col_str = ",".join(col.upper() for col in cmd_dict)
+    val_str = ",".join("?" for _ in cmd_dict)
 
     query = "INSERT INTO " + name.upper() + " (" + col_str + ") VALUES (" + val_str + ");"
     cursor = conn.cursor()
-    cursor.execute(query, tuple(val_list))
-    conn.commit()
+    cursor.execute(query, tuple(cmd_dict.values()))
+    if(commit):
+        conn.commit()
     cursor.close()
     return
 
 
 '''
-Select query -> for now we allow where + orderby commands.
+Insert (many) -> list of dictionaries, all with the same columns as the first one
+(ValueError naming the row index otherwise, before anything is inserted).
+one executemany + a single commit instead of one commit (fsync) per row.
+returns the number of rows inserted.
 '''
-def select(conn,col_list,where_clause,order_by,name):
-    q = "SELECT "
-    if(col_list == None or len(col_list) == 0):
-        q += "*"
-    else:
-        for c in col_list:
-            q += c.upper() + ","
-        q = q[:-1]
+def many_insert(conn,dict_list,name,commit=True):
+    if(len(dict_list) == 0):
+        return 0
+
+    cols = list(dict_list[0].keys())
+    col_set = set(cols)
+    for i, d in enumerate(dict_list):
+        if(set(d.keys()) != col_set):
+            raise ValueError("row " + str(i) + " has columns " + repr(sorted(d.keys())) + ", expected " + repr(sorted(cols)))
+    col_str = ",".join(c.upper() for c in cols)
+    val_str = ",".join("?" for _ in cols)
+    val_list = [tuple(d[c] for c in cols) for d in dict_list]
+
+    query = "INSERT INTO " + name.upper() + " (" + col_str + ") VALUES (" + val_str + ");"
+    cursor = conn.cursor()
+    cursor.executemany(query, val_list)
+    if(commit):
+        conn.commit()
+    rc = cursor.rowcount
+    cursor.close()
+    return rc
+
 
-    q += " FROM " + name.upper()
+'''
+Where clause -> dict gets turned into "COL = ? AND COL = ?" with the values bound as params,
+anything else is treated as a raw sql string. returns ("", []) if there is nothing to filter on
+(update / delete refuse an empty dict before getting here).
 
-    vals = []
-    if(where_clause != None):
-        if(type(where_clause) == dict):
-            q += " WHERE "
-            for (k,v) in where_clause.items():
-                q += k.upper() + " = ? AND "
+a list / tuple value becomes "COL IN (?,?,...)" -> fetch the rows for many ids in one query instead of one query per id:
+    select(conn, None, {"meeting_id": [1, 2, 3]}, "meeting_id", "key_points")
+'''
+def _where_sql(where_clause):
+    if(where_clause == None):
+        return "", []
+    if(type(where_clause) == dict):
+        if(len(where_clause) == 0):
+            return "", []
+        # sorted so {"a":..,"b":..} and {"b":..,"a":..} produce the same sql text -> sqlite3's statement cache gets reused.
+        shape = []
+        vals = []
+        for k in sorted(where_clause):
+            v = where_clause[k]
+            if(type(v) == list or type(v) == tuple):
+                shape.append((k, len(v)))
+                vals.extend(v)
+            else:
+                shape.append((k, None))
                 vals.append(v)
-            q = q[:-5]
-        else:
-            q += " WHERE " + where_clause
-
-    if(order_by != None):
-        q += " ORDER BY "
-        if(type(order_by) == list):
-            for c in order_by:
-                q += c.upper() + ","
-            q = q[:-1]
+        return _where_text(tuple(shape)), vals
+    return " WHERE " + where_clause, []
+
+
+# (column, None) -> "COL = ?", (column, n) -> "COL IN (n placeholders)". cached so repeated queries skip the string building.
+@functools.lru_cache(maxsize=256)
+def _where_text(shape):
+    conds = []
+    for (k,n) in shape:
+        if(n == None):
+            conds.append(k.upper() + " = ?")
         else:
-            q += order_by.upper()
+            conds.append(k.upper() + " IN (" + ",".join("?" for _ in range(n)) + ")")
+    return " WHERE " + " AND ".join(conds)
 
-    q += ";"
+
+'''
+Select query -> for now we allow where + orderby commands, plus limit / offset for paging.
+
+order_by: column name or list / tuple of column names, each optionally followed by ASC / DESC. these get pasted into the sql text
+so anything else raises ValueError.
+limit / offset are bound as params, so every page of the same query reuses one cached statement.
+'''
+def select(conn,col_list,where_clause,order_by,name,limit=None,offset=None):
+    cols = None if(col_list == None or len(col_list) == 0) else tuple(col_list)
+    order = None if(order_by == None) else (tuple(order_by) if type(order_by) in (list, tuple) else (order_by,))
+    paged = (limit != None or offset != None)
+
+    where_sql, vals = _where_sql(where_clause)
+    q = _select_text(cols, where_sql, order, name, paged)
+
+    if(paged):
+        # sqlite needs a LIMIT before OFFSET; -1 means no limit
+        vals = vals + [limit if limit != None else -1, offset if offset != None else 0]
 
     cursor = conn.cursor()
-    if(len(vals) > 0):
-        cursor.execute(q, tuple(vals))
-    else:
-        cursor.execute(q)
+    cursor.execute(q, tuple(vals))
     rows = cursor.fetchall()
     cursor.close()
     return rows
 
 
+# the select sql text only depends on these hashable args -> build it once per distinct query shape.
+@functools.lru_cache(maxsize=256)
+def _select_text(cols, where_sql, order, name, paged):
+    cols_sql = "*" if cols == None else ",".join(c.upper() for c in cols)
+
+    order_sql = ""
+    if(order != None):
+        for c in order:
+            if(not _ORDER_RE.match(c)):
+                raise ValueError("invalid order_by column: " + repr(c))
+        order_sql = " ORDER BY " + ",".join(c.upper() for c in order)
+
+    page_sql = " LIMIT ? OFFSET ?" if paged else ""
+
+    return "SELECT " + cols_sql + " FROM " + name.upper() + where_sql + order_sql + page_sql + ";"
+
+
 '''
-Update rows -> where claus allowed
+Count rows -> SELECT COUNT(*) so sqlite does the counting instead of fetching every row just to len() it.
+where clause works the same as in select.
 '''
-def update(conn, col_list, where_clause, name):
-    q = "UPDATE " + name.upper() + " SET "
-    vals = []
+def count(conn,where_clause,name):
+    where_sql, vals = _where_sql(where_clause)
+    q = "SELECT COUNT(*) FROM " + name.upper() + where_sql + ";"
 
-    for (k,v) in col_list.items():
-        q += k.upper() + " = ?,"
-        vals.append(v)
-    q = q[:-1]
+    cursor = conn.cursor()
+    cursor.execute(q, tuple(vals))
+    n = cursor.fetchone()[0]
+    cursor.close()
+    return n
 
-    if(where_clause != None):
-        if(type(where_clause) == dict):
-            q += " WHERE "
-            for (k,v) in where_clause.items():
-                q += k.upper() + " = ? AND "
-                vals.append(v)
-            q = q[:-5]
-        else:
-            q += " WHERE " + where_clause
 
-    q += ";"
+'''
+Update rows -> where claus allowed.
+an empty where dict raises ValueError instead of silently hitting every row; pass None to really update them all.
+'''
+def update(conn, col_list, where_clause, name, commit=True):
+    if(type(where_clause) == dict and len(where_clause) == 0):
+        raise ValueError("empty where clause for update on " + name + "; pass None to update every row")
+    set_sql = ",".join(k.upper() + " = ?" for k in col_list)
+    where_sql, where_vals = _where_sql(where_clause)
+    vals = list(col_list.values()) + where_vals
+
+    q = "UPDATE " + name.upper() + " SET " + set_sql + where_sql + ";"
 
     cursor = conn.cursor()
     cursor.execute(q, tuple(vals))
-    conn.commit()
+    if(commit):
+        conn.commit()
     rc = cursor.rowcount
     cursor.close()
     return rc
 
 
 '''
-Delete rows ->
+Delete rows -> where dict same as update: {} raises ValueError, None deletes every row.
 '''
-def delete(conn, cmd_dict , name):
-    q = "DELETE FROM " + name.upper()
-    vals = []
-
-    if(cmd_dict != None):
-        if(type(cmd_dict) == dict):
-            q += " WHERE "
-            for (k,v) in cmd_dict.items():
-                q += k.upper() + " = ? AND "
-                vals.append(v)
-            q = q[:-5]
-        else:
-            q += " WHERE " + cmd_dict
-
-    q += ";"
+def delete(conn, cmd_dict , name, commit=True):
+    if(type(cmd_dict) == dict and len(cmd_dict) == 0):
+        raise ValueError("empty where clause for delete on " + name + "; pass None to delete every row")
+    where_sql, vals = _where_sql(cmd_dict)
+    q = "DELETE FROM " + name.upper() + where_sql + ";"
 
     cursor = conn.cursor()
-    if(len(vals) > 0):
-        cursor.execute(q, tuple(vals))
-    else:
-        cursor.execute(q)
-    conn.commit()
+    cursor.execute(q, tuple(vals))
+    if(commit):
+        conn.commit()
     rc = cursor.rowcount
     cursor.close()
     return rc
-
-
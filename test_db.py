@@ -2,13 +2,12 @@
 Test suite for db.py
 '''
 import os
+import tempfile
 import db_func as db
 
-# remove existing db if any
-if os.path.exists("test.db"):
-    os.remove("test.db")
-
-conn = db.create_database("test")
+# fresh directory per run -> no stale test.db / -wal / -shm to clean up first, and nothing left in the cwd
+tmp_dir = tempfile.TemporaryDirectory()
+conn = db.create_database(os.path.join(tmp_dir.name, "test"))
 
 # define schema
 spec = {
@@ -16,11 +15,14 @@ spec = {
     "summary_heading": ["VARCHAR(255)"],
     "summary_points": ["LONGTEXT"],
     "summary_todo": ["LONGTEXT"],
-    "Primary Key": "usr_id"
+    "Primary Key": "usr_id",
+    "Index": ["summary_heading"]
 }
 
 # create table
 db.create_table(conn, spec, "user_summary")
+# second create is a no-op
+db.create_table(conn, spec, "user_summary", if_not_exists=True)
 
 # insert a few rows
 row1 = {
@@ -37,8 +39,36 @@ row2 = {
     "summary_todo": "Optimize joins"
 }
 
-db.single_insert(conn, row1, "user_summary")
-db.single_insert(conn, row2, "user_summary")
+# one transaction for both inserts -> a single commit instead of one per row
+with conn:
+    db.single_insert(conn, row1, "user_summary", commit=False)
+    db.single_insert(conn, row2, "user_summary", commit=False)
+
+# bulk insert
+row3 = {
+    "usr_id": "U003",
+    "summary_heading": "Standup",
+    "summary_points": "Reviewed backlog",
+    "summary_todo": "Assign tickets"
+}
+
+row4 = {
+    "summary_heading": "Retro",
+    "usr_id": "U004",
+    "summary_points": "Discussed blockers",
+    "summary_todo": "Follow up"
+}
+
+print("Bulk inserting U003, U004")
+rc = db.many_insert(conn, [row3, row4], "user_summary")
+print("Rows inserted:", rc)
+
+# rows with a different column set are rejected before anything is written
+bad_row = {"usr_id": "U005", "summary_heading": "Planning"}
+try:
+    db.many_insert(conn, [row3, bad_row], "user_summary")
+except ValueError as e:
+    print("Rejected bulk insert:", e)
 
 # select all
 print("All Rows")
@@ -46,12 +76,37 @@ rows = db.select(conn, None, None, None, "user_summary")
 for r in rows:
     print(dict(r))
 
+print("Row count:", db.count(conn, None, "user_summary"))
+
 # select with where
 print("\n=Rows where usr_id = U001")
 rows = db.select(conn, None, {"usr_id": "U001"}, None, "user_summary")
 for r in rows:
     print(dict(r))
 
+# select with IN
+print("\nRows where usr_id in (U001, U003)")
+rows = db.select(conn, None, {"usr_id": ["U001", "U003"]}, "usr_id", "user_summary")
+for r in rows:
+    print(dict(r))
+
+# select a page
+print("\nSecond page of 2, ordered by usr_id")
+rows = db.select(conn, None, None, "usr_id", "user_summary", limit=2, offset=2)
+for r in rows:
+    print(dict(r))
+
+# tuple order_by works like a list
+print("\nOrdered by (summary_heading DESC, usr_id)")
+rows = db.select(conn, ["usr_id"], None, ("summary_heading DESC", "usr_id"), "user_summary")
+print([r["usr_id"] for r in rows])
+
+# order_by is pasted into the sql, so anything that isn't a plain column name is rejected
+try:
+    db.select(conn, None, None, "usr_id; DROP TABLE user_summary", "user_summary")
+except ValueError as e:
+    print("Rejected order_by:", e)
+
 # update row
 print("\nUpdating summary_heading for U002")
 rc = db.update(conn, {"summary_heading": "Updated Heading"}, {"usr_id": "U002"}, "user_summary")
@@ -73,10 +128,52 @@ print("\nRemaining rows")
 for r in rows:
     print(dict(r))
 
+# an empty where dict must not touch every row
+try:
+    db.delete(conn, {}, "user_summary")
+except ValueError as e:
+    print("Rejected empty where:", e)
+try:
+    db.update(conn, {"summary_todo": "x"}, {}, "user_summary")
+except ValueError as e:
+    print("Rejected empty where:", e)
+print("Row count after rejected writes:", db.count(conn, None, "user_summary"))
+
+# grouped writes -> one transaction, committed by the with block
+print("\nUpdating U003 + deleting U004 in one transaction")
+with conn:
+    db.update(conn, {"summary_todo": "Done"}, {"usr_id": "U003"}, "user_summary", commit=False)
+    db.delete(conn, {"usr_id": "U004"}, "user_summary", commit=False)
+
+rows = db.select(conn, None, None, None, "user_summary")
+for r in rows:
+    print(dict(r))
+
+# child table with ON DELETE CASCADE
+notes_spec = {
+    "note_id": ["INTEGER"],
+    "usr_id": ["VARCHAR(255)", "NOT NULL"],
+    "note": ["LONGTEXT"],
+    "Primary Key": "note_id",
+    "Foreign Key": [("usr_id", "user_summary", "CASCADE")],
+    "Index": ["usr_id"]
+}
+db.create_table(conn, notes_spec, "user_notes")
+db.many_insert(conn, [
+    {"note_id": 1, "usr_id": "U003", "note": "first"},
+    {"note_id": 2, "usr_id": "U003", "note": "second"}
+], "user_notes")
+
+print("\nDeleting U003 cascades to its notes")
+db.delete(conn, {"usr_id": "U003"}, "user_summary")
+print("Notes left:", db.count(conn, None, "user_notes"))
+
 # drop table
 print("\nDropping table")
+db.drop_table(conn, "user_notes")
 db.drop_table(conn, "user_summary")
 
 conn.close()
+tmp_dir.cleanup()
 print("\nDone")
 